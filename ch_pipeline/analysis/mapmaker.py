@@ -5,6 +5,7 @@ Tools for making maps from CHIME data.
 
 import numpy as np
 import scipy.constants
+import scipy.fft
 
 from caput import config
 
@@ -16,6 +17,9 @@ from ch_util import ephemeris
 
 from ..core import containers
 
+# Polarisation axis of the ring maps
+_RINGMAP_POL = np.array(["XX", "reXY", "imXY", "YY"])
+
 
 class RingMapMaker(task.SingleTask):
     """A simple and quick map-maker that forms a series of beams on the meridian.
@@ -46,6 +50,16 @@ class RingMapMaker(task.SingleTask):
 
     single_beam: bool
         Only calculate the map for the central beam. Default is False.
+
+    precision : string ('double' or 'single')
+        Floating point precision of the intermediate arrays used to grid the
+        visibilities and form the map. Single precision halves the memory
+        required. Default is 'double'.
+
+    fft_workers : int
+        Number of threads used for the FFTs in the EW direction. Negative values
+        count back from the number of CPUs, so -1 uses all of them. Reduce this
+        when running several MPI processes per node. Default is -1.
     """
 
     npix = config.Property(proptype=int, default=512)
@@ -60,6 +74,10 @@ class RingMapMaker(task.SingleTask):
 
     single_beam = config.Property(proptype=bool, default=False)
 
+    precision = config.enum(["double", "single"], default="double")
+
+    fft_workers = config.Property(proptype=int, default=-1)
+
     def setup(self, tel):
         """Set the Telescope instance to use.
 
@@ -78,6 +96,69 @@ class RingMapMaker(task.SingleTask):
 
         self.telescope = io.get_telescope(tel)
 
+        # Cache the feed properties used to place each baseline on the grid, so
+        # they can be looked up for all products at once. Only CHIME cylinder
+        # feeds appear in the stacked products, so the defaults for any other
+        # kind of input are never used.
+        feeds = self.telescope.feeds
+        self._feed_pol = np.array(
+            [int(getattr(f, "pol", None) == "S") for f in feeds], dtype=np.int64
+        )
+        self._feed_cyl = np.array([getattr(f, "cyl", 0) for f in feeds], dtype=np.int64)
+
+        # TODO: don't use this internal property. This can probably wait
+        # until the RingMapMaker gets completely moved into draco
+        self._feed_ypos = np.array(
+            [f._pos[1] if hasattr(f, "_pos") else 0.0 for f in feeds],
+            dtype=np.float64,
+        )
+
+    _grid_cache = None
+
+    def _grid_index(self, prodstack):
+        """Find the location of each stacked product on the unpacked 2D grid.
+
+        This only depends on the products, so the result is cached and reused
+        while the products are unchanged.
+
+        Parameters
+        ----------
+        prodstack : np.ndarray[nprod]
+            The pair of feeds for each stacked product.
+
+        Returns
+        -------
+        pind, xind, yind : np.ndarray[nprod]
+            Polarisation, EW and NS grid index of each product.
+        min_ysep, max_ysep : float
+            Minimum and maximum non-zero NS baseline separation.
+        """
+
+        key = prodstack.tobytes()
+
+        if self._grid_cache is not None and self._grid_cache[0] == key:
+            return self._grid_cache[1]
+
+        ii, jj = prodstack["input_a"], prodstack["input_b"]
+
+        conj = self.telescope.feedconj[ii, jj]
+        ii, jj = np.where(conj, jj, ii), np.where(conj, ii, jj)
+
+        pind = 2 * self._feed_pol[ii] + self._feed_pol[jj]
+        xind = np.abs(self._feed_cyl[ii] - self._feed_cyl[jj])
+        ysep = self._feed_ypos[ii] - self._feed_ypos[jj]
+
+        abs_ysep = np.abs(ysep)
+        abs_ysep = abs_ysep[abs_ysep > 0.0]
+        min_ysep, max_ysep = abs_ysep.min(), abs_ysep.max()
+
+        yind = np.round(ysep / min_ysep).astype(np.int64)
+
+        grid = (pind, xind, yind, min_ysep, max_ysep)
+        self._grid_cache = (key, grid)
+
+        return grid
+
     def process(self, sstream):
         """Computes the ringmap.
 
@@ -100,31 +181,7 @@ class RingMapMaker(task.SingleTask):
         nra = ra.size
 
         # Construct mapping from vis array to unpacked 2D grid
-        nprod = sstream.prodstack.shape[0]
-        pind = np.zeros(nprod, dtype=np.int64)
-        xind = np.zeros(nprod, dtype=np.int64)
-        ysep = np.zeros(nprod, dtype=np.float64)
-
-        for pp, (ii, jj) in enumerate(sstream.prodstack):
-            if self.telescope.feedconj[ii, jj]:
-                ii, jj = jj, ii
-
-            fi = self.telescope.feeds[ii]
-            fj = self.telescope.feeds[jj]
-
-            pind[pp] = 2 * int(fi.pol == "S") + int(fj.pol == "S")
-            xind[pp] = np.abs(fi.cyl - fj.cyl)
-
-            # TODO: don't use this internal property. This can probably wait
-            # until the RingMapMaker gets completely moved into draco
-            ysep[pp] = fi._pos[1] - fj._pos[1]
-
-        abs_ysep = np.abs(ysep)
-        min_ysep, max_ysep = np.percentile(abs_ysep[abs_ysep > 0.0], [0, 100])
-
-        yind = np.round(ysep / min_ysep).astype(np.int64)
-
-        grid_index = list(zip(pind, xind, yind))
+        pind, xind, yind, min_ysep, max_ysep = self._grid_index(sstream.prodstack)
 
         # Define several variables describing the baseline configuration.
         nfeed = int(np.round(max_ysep / min_ysep)) + 1
@@ -133,13 +190,18 @@ class RingMapMaker(task.SingleTask):
         nbeam = 1 if self.single_beam else int(2 * ncyl - 1)
 
         # Define polarisation axis
-        pol = np.array(["XX", "reXY", "imXY", "YY"])
+        pol = _RINGMAP_POL
         npol = len(pol)
 
         # Create empty array for output
-        vis = np.zeros((nfreq, npol, nra, ncyl, nvis_1d), dtype=np.complex128)
-        invvar = np.zeros((nfreq, npol, nra, ncyl, nvis_1d), dtype=np.float64)
-        weight = np.zeros((nfreq, npol, nra, ncyl, nvis_1d), dtype=np.float64)
+        if self.precision == "single":
+            fdtype, cdtype = np.float32, np.complex64
+        else:
+            fdtype, cdtype = np.float64, np.complex128
+
+        vis = np.zeros((nfreq, npol, nra, ncyl, nvis_1d), dtype=cdtype)
+        invvar = np.zeros((nfreq, npol, nra, ncyl, nvis_1d), dtype=fdtype)
+        weight = np.zeros((nfreq, npol, nra, ncyl, nvis_1d), dtype=fdtype)
 
         # If natural or uniform weighting was chosen, then calculate the
         # redundancy of the collated visibilities.
@@ -155,22 +217,36 @@ class RingMapMaker(task.SingleTask):
                 redundancy = (redundancy > 0).astype(np.float32)
 
         # De-reference distributed arrays outside loop to save repeated MPI calls
-        ssv = sstream.vis[:]
-        ssw = sstream.weight[:]
-
-        # Unpack visibilities into new array
-        for vis_ind, (p_ind, x_ind, y_ind) in enumerate(grid_index):
-            # Handle different options for weighting baselines
-            if self.weight == "inverse_variance":
-                w = ssw[:, vis_ind]
-            else:
-                w = (ssw[:, vis_ind] > 0.0).astype(np.float32)
-                w *= redundancy[np.newaxis, vis_ind]
-
-            if x_ind != 0 or not self.exclude_intracyl:
-                vis[:, p_ind, :, x_ind, y_ind] = ssv[:, vis_ind]
-                invvar[:, p_ind, :, x_ind, y_ind] = ssw[:, vis_ind]
-                weight[:, p_ind, :, x_ind, y_ind] = w
+        ssv = sstream.vis[:].local_array
+        ssw = sstream.weight[:].local_array
+
+        # Unpack visibilities into new array. The grid indices are separated by
+        # slices, so the baselines end up on the leading axis of the indexed
+        # arrays and the source arrays must be transposed to match. All
+        # baselines are unpacked, so that the source arrays are only read once
+        # through views, and any excluded intracylinder baselines are zeroed
+        # afterwards.
+        grid_index = (slice(None), pind, slice(None), xind, yind)
+
+        vis[grid_index] = ssv.swapaxes(0, 1)
+        invvar[grid_index] = ssw.swapaxes(0, 1)
+
+        if self.exclude_intracyl:
+            vis[..., 0, :] = 0.0
+            invvar[..., 0, :] = 0.0
+
+        # Handle different options for weighting baselines
+        if self.weight == "inverse_variance":
+            weight[:] = invvar
+        else:
+            # The redundancy does not depend on frequency, so unpack it onto a
+            # grid without the frequency axis and broadcast it against the mask
+            # of baselines with non-zero weight
+            red = np.zeros((npol, nra, ncyl, nvis_1d), dtype=fdtype)
+            red[grid_index[1:]] = redundancy
+
+            weight[:] = invvar > 0.0
+            weight *= red[np.newaxis]
 
         # Remove auto-correlations
         if not self.include_auto:
@@ -186,7 +262,11 @@ class RingMapMaker(task.SingleTask):
         # Construct phase array
         el = self.span * np.linspace(-1.0, 1.0, self.npix)
 
-        vis_pos_1d = np.fft.fftfreq(nvis_1d, d=(1.0 / (nvis_1d * min_ysep)))
+        # NS positions of the grid baselines. Negative separations wrap around to
+        # the end of the axis, matching the negative `yind` used to unpack them.
+        vis_pos_1d = min_ysep * np.concatenate(
+            (np.arange(nfeed), np.arange(1 - nfeed, 0))
+        )
 
         # Create empty ring map
         rm = containers.RingMap(
@@ -200,22 +280,39 @@ class RingMapMaker(task.SingleTask):
         rm.redistribute("freq")
 
         # Estimate rms noise in the ring map by propagating estimates
-        # of the variance in the visibilities
-        rm.rms[:] = np.sqrt(
-            2 * np.sum(tools.invert_no_zero(invvar) * weight**2.0, axis=(-2, -1))
-        ).transpose(1, 0, 2)
-
-        # Dereference datasets
-        rmm = rm.map[:]
-        rmb = rm.dirty_beam[:]
-
-        # Pre-allocate arrays that will be reused inside loop
+        # of the variance in the visibilities. The squared weights are applied in
+        # place to avoid creating further temporaries the size of the full grid.
+        var = tools.invert_no_zero(invvar)
+        var *= weight
+        var *= weight
+        rm.rms[:] = np.sqrt(2 * np.sum(var, axis=(-2, -1))).transpose(1, 0, 2)
+        del var
+
+        # Dereference datasets to the local frequency sections, so the writes
+        # for each frequency below are plain strided array copies rather than
+        # going through the distributed array indexing
+        rmm = rm.map[:].local_array
+        rmb = rm.dirty_beam[:].local_array
+
+        # Pre-allocate arrays that will be reused inside loop. The map and the
+        # dirty beam are stacked along the leading axis so that both are
+        # transformed with a single FFT call.
         save_nb = 1 if self.single_beam else nbeam
         pa = np.zeros(vis_pos_1d.shape + el.shape, dtype=vis.dtype)
-        bfm_y = np.zeros((npol, nra, ncyl, self.npix), dtype=vis.dtype)
-        sb_y = np.zeros((npol, nra, ncyl, self.npix), dtype=vis.dtype)
-        bfm = np.zeros((npol, nra, save_nb, self.npix), dtype=vis.dtype)
-        sb = np.zeros((npol, nra, save_nb, self.npix), dtype=vis.dtype)
+        wvis = np.zeros((npol, nra, ncyl, nvis_1d), dtype=vis.dtype)
+        bf_y = np.zeros((2, npol, nra, ncyl, self.npix), dtype=vis.dtype)
+        bf_co = np.zeros((2, 2, nra, save_nb, self.npix), dtype=fdtype)
+        bf_x = np.zeros((2, 2, nra, save_nb, self.npix), dtype=vis.dtype)
+
+        # Polarisation slices for the co-pol (XX, YY) and cross-pol (reXY, imXY)
+        # products
+        copol_ind = slice(0, npol, 3)
+        xpol_ind = slice(1, 3)
+
+        # The phase of the y-direction transform only depends on frequency
+        # through an overall scaling by the inverse wavelength, so construct the
+        # frequency independent part once
+        phase = (-2.0j * np.pi * vis_pos_1d[:, np.newaxis]) * el[np.newaxis, :]
 
         # Loop over local frequencies and fill ring map
         for lfi, fi in sstream.vis[:].enumerate(0):
@@ -225,42 +322,58 @@ class RingMapMaker(task.SingleTask):
             wv = scipy.constants.c * 1e-6 / fr
 
             # Inverse discrete Fourier transform in y-direction
-            pa[:] = np.exp(
-                (-2.0j * np.pi / wv * vis_pos_1d[:, np.newaxis]) * el[np.newaxis, :]
-            )
+            # (computed in place to avoid temporaries)
+            np.multiply(phase, 1.0 / wv, out=pa)
+            np.exp(pa, out=pa)
 
             # Perform inverse discrete fourier transform in y-direction
-            # and inverse fast fourier transform in x-direction
-            bfm_y[:] = np.matmul(weight[lfi] * vis[lfi], pa)
-            sb_y[:] = np.matmul(weight[lfi], pa)
+            # and inverse fast fourier transform in x-direction. All operands are
+            # C-contiguous with the baseline axis innermost, which is the axis
+            # contracted by the matmul.
+            np.multiply(weight[lfi], vis[lfi], out=wvis)
+            np.matmul(wvis, pa, out=bf_y[0])
+            # The weights are real, so for the dirty beam this can be done as a
+            # real matrix product against the interleaved real and imaginary
+            # parts of the phase array, which is half the work of a complex one
+            np.matmul(weight[lfi], pa.view(fdtype), out=bf_y[1].view(fdtype))
             if self.single_beam:
                 # Only need the 0th term if the irfft, equivalent to adding in EW
                 # direction
-                bfm[:] = np.sum(bfm_y, axis=2)[:, :, np.newaxis, ...]
-                sb[:] = np.sum(sb_y, axis=2)[:, :, np.newaxis, ...]
+                bf_co[:] = 2 * np.sum(bf_y[:, copol_ind], axis=3, keepdims=True).real
+                bf_x[:] = np.sum(bf_y[:, xpol_ind], axis=3, keepdims=True)
             else:
-                bfm[:] = np.fft.ifft(bfm_y, nbeam, axis=2) * nbeam
-                sb[:] = np.fft.ifft(sb_y, nbeam, axis=2) * nbeam
-
-            # Save to container (shifting to the final axis ordering)
-            # for co-pol we take twice the real part
-            # to complete sum over negative baselines
-            copol_ind = [0, 3]
-            rmm[:, copol_ind, lfi] = 2 * bfm[copol_ind].real.transpose(2, 0, 1, 3)
-            rmb[:, copol_ind, lfi] = 2 * sb[copol_ind].real.transpose(2, 0, 1, 3)
-            # for cross-pol we save real and imaginary parts of complex map formed
-            # by combining positive and negative baselines (which are in the other index)
-            xpol_ind = [1, 2]
-            rmm[:, xpol_ind, lfi] = (
-                (bfm[xpol_ind[0]] + bfm[xpol_ind[1]].conj())
-                .view("(2,)float")
-                .transpose(1, 3, 0, 2)
-            )
-            rmb[:, xpol_ind, lfi] = (
-                (sb[xpol_ind[0]] + sb[xpol_ind[1]].conj())
-                .view("(2,)float")
-                .transpose(1, 3, 0, 2)
-            )
+                # for co-pol we need twice the real part to complete the sum over
+                # negative baselines. This is the irfft of the non-negative EW
+                # baselines once the zero separation term is doubled.
+                bf_y[:, copol_ind, :, 0] *= 2
+                bf_co[:] = scipy.fft.irfft(
+                    bf_y[:, copol_ind],
+                    nbeam,
+                    axis=3,
+                    overwrite_x=True,
+                    workers=self.fft_workers,
+                )
+                bf_co *= nbeam
+                bf_x[:] = scipy.fft.ifft(
+                    bf_y[:, xpol_ind],
+                    nbeam,
+                    axis=3,
+                    overwrite_x=True,
+                    workers=self.fft_workers,
+                )
+                bf_x *= nbeam
+
+            # Save map and dirty beam to container (shifting to the final axis
+            # ordering)
+            for out, co, xp in zip((rmm, rmb), bf_co, bf_x):
+                out[:, copol_ind, lfi] = co.transpose(2, 0, 1, 3)
+                # for cross-pol we save real and imaginary parts of complex map
+                # formed by combining positive and negative baselines (which are
+                # in the other index). This is accumulated in place in the
+                # scratch buffer to avoid temporaries.
+                np.conjugate(xp[1], out=xp[1])
+                xp[1] += xp[0]
+                out[:, xpol_ind, lfi] = xp[1].view((fdtype, 2)).transpose(1, 3, 0, 2)
 
         return rm
 
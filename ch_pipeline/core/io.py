@@ -489,8 +489,9 @@ class FilterExisting(task.MPILoggedTask):
 
             files = glob.glob("*")
             if self.existing_csd_regex:
+                csd_regex = re.compile(self.existing_csd_regex)
                 for file_ in files:
-                    mo = re.search(self.existing_csd_regex, file_)
+                    mo = csd_regex.search(file_)
                     if mo is not None:
                         self.csd_list.append(int(mo.group(1)))
 
@@ -29,6 +29,9 @@ from caput.cache import cached_property
 # Get the logger for the module
 logger = logging.getLogger(__name__)
 
+# Pathfinder channelization of 1024 bins between 400 and 800 MHz
+_PATHFINDER_FREQ = np.linspace(800.0, 400.0, 1024, endpoint=False)
+
 
 class CHIME(telescope.PolarisedTelescope):
     """Model telescope for the CHIME/Pathfinder.
@@ -196,8 +199,11 @@ class CHIME(telescope.PolarisedTelescope):
         if self.layout is None:
             raise Exception("Layout attributes not set.")
 
-        # Fetch feed layout from database
-        feeds = tools.get_correlator_inputs(self.layout, self.correlator)
+        # Fetch feed layout from database on rank 0 only, and share it with the
+        # other ranks
+        feeds = None
+        if mpiutil.rank0:
+            feeds = tools.get_correlator_inputs(self.layout, self.correlator)
 
         if mpiutil.size > 1:
             feeds = mpiutil.world.bcast(feeds, root=0)
@@ -207,6 +213,10 @@ class CHIME(telescope.PolarisedTelescope):
 
         self._feeds = feeds
 
+        # Reset anything derived from the previous feeds
+        self._feeds_sel = None
+        self._pos = None
+
     def _finalise_config(self):
         # Override base method to implement automatic loading of layout when
         # configuring from YAML.
@@ -273,7 +283,8 @@ class CHIME(telescope.PolarisedTelescope):
         """
         if self.use_pathfinder_freq:
             # Use pathfinder channelization of 1024 bins between 400 and 800 MHz.
-            basefreq = np.linspace(800.0, 400.0, 1024, endpoint=False)
+            # This is shared, so must not be modified in place
+            basefreq = _PATHFINDER_FREQ
 
             # Bin the channels together
             if len(basefreq) % self.channel_bin != 0:
@@ -281,12 +292,14 @@ class CHIME(telescope.PolarisedTelescope):
                     "Channel binning must exactly divide the total number of channels"
                 )
 
-            basefreq = basefreq.reshape(-1, self.channel_bin).mean(axis=-1)
+            if self.channel_bin > 1:
+                basefreq = basefreq.reshape(-1, self.channel_bin).mean(axis=-1)
 
             # If requested, select subset of frequencies.
             if self.freq_physical:
+                freq_physical = np.asarray(self.freq_physical, dtype=np.float64)
                 basefreq = basefreq[
-                    [np.argmin(np.abs(basefreq - freq)) for freq in self.freq_physical]
+                    np.abs(basefreq[:, np.newaxis] - freq_physical).argmin(axis=0)
                 ]
 
             elif self.channel_range and (len(self.channel_range) <= 3):
@@ -302,16 +315,20 @@ class CHIME(telescope.PolarisedTelescope):
             # Otherwise use the standard method
             telescope.TransitTelescope.calculate_frequencies(self)
 
+    _feeds_sel = None
+
     @property
     def feeds(self):
         """Return a description of the feeds as a list of :class:`tools.CorrInput` instances."""
 
         if self.input_sel is None:
-            feeds = self._feeds
-        else:
-            feeds = [self._feeds[fi] for fi in self.input_sel]
+            return self._feeds
 
-        return feeds
+        # Cache the selected feeds as this is accessed for every beam evaluation
+        if self._feeds_sel is None:
+            self._feeds_sel = [self._feeds[fi] for fi in self.input_sel]
+
+        return self._feeds_sel
 
     @property
     def input_index(self):
@@ -319,9 +336,9 @@ class CHIME(telescope.PolarisedTelescope):
         for generating synthetic datasets.
         """
         # Extract lists of channel ID and serial numbers
-        channels, feed_sn = list(
-            zip(*[(feed.id, feed.input_sn) for feed in self.feeds])
-        )
+        feeds = self.feeds
+        channels = [feed.id for feed in feeds]
+        feed_sn = [feed.input_sn for feed in feeds]
 
         # Create an input index map and return it.
         from ch_util import andata
@@ -370,30 +387,50 @@ class CHIME(telescope.PolarisedTelescope):
         In all cases, any other type of feed gets set to `-1` and should be
         ignored.
         """
-        # Make beam class just channel number.
-
-        def _feedclass(f, redundant_cyl=False):
-            if tools.is_array(f):
-                if tools.is_array_x(f):  # feed is X polarisation
-                    pol = 0
-                else:  # feed is Y polarisation
-                    pol = 1
-
-                if redundant_cyl:
-                    return 2 * f.cyl + pol
-                else:
-                    return pol
-            return -1
+        # X polarisation feeds get 0 and Y polarisation feeds get 1
+        pol = np.where(self._is_array_x, 0, 1)
 
         if self.stack_type == "redundant":
-            return np.array([_feedclass(f) for f in self.feeds])
+            beamclass = pol
         elif self.stack_type == "redundant_cyl":
-            return np.array([_feedclass(f, redundant_cyl=True) for f in self.feeds])
+            cyl = np.array([getattr(f, "cyl", 0) for f in self.feeds], dtype=np.int64)
+            beamclass = 2 * cyl + pol
         else:
-            beamclass = [
-                fi if tools.is_array(feed) else -1 for fi, feed in enumerate(self.feeds)
-            ]
-            return np.array(beamclass)
+            # Make beam class just channel number.
+            beamclass = np.arange(len(self.feeds))
+
+        # Feeds that are not CHIME cylinder antennas get beam class -1
+        return np.where(self._is_array, beamclass, -1)
+
+    @cached_property
+    def _is_array(self):
+        """Mask of the feeds which are CHIME cylinder antennas."""
+        return np.fromiter(
+            (tools.is_array(f) for f in self.feeds), dtype=bool, count=len(self.feeds)
+        )
+
+    @cached_property
+    def _is_array_x(self):
+        """Mask of the feeds which are X polarisation CHIME cylinder antennas."""
+        return np.fromiter(
+            (tools.is_array_x(f) for f in self.feeds),
+            dtype=bool,
+            count=len(self.feeds),
+        )
+
+    @cached_property
+    def _is_array_y(self):
+        """Mask of the feeds which are Y polarisation CHIME cylinder antennas."""
+        return np.fromiter(
+            (tools.is_array_y(f) for f in self.feeds),
+            dtype=bool,
+            count=len(self.feeds),
+        )
+
+    @cached_property
+    def _beam_rotation(self):
+        """Rotation of the beams in radians as (yaw, pitch, roll)."""
+        return np.radians([-self.rotation_angle, 0.0, 0.0])
 
     @cached_property
     def polarisation(self):
@@ -406,15 +443,10 @@ class CHIME(telescope.PolarisedTelescope):
             One-dimensional array with the polarization for each feed ('X' or 'Y').
         """
 
-        def _pol(f):
-            if tools.is_array(f):
-                if tools.is_array_x(f):  # feed is X polarisation
-                    return "X"
-                else:  # feed is Y polarisation
-                    return "Y"
-            return "N"
+        # Use the cached feed masks rather than classifying every feed again
+        pol = np.where(self._is_array_x, "X", "Y")
 
-        return np.asarray([_pol(f) for f in self.feeds], dtype=str)
+        return np.where(self._is_array, pol, "N")
 
     #
     # === Setup the primary beams ===
@@ -452,7 +484,7 @@ class CHIME(telescope.PolarisedTelescope):
         if feed_obj is None:
             raise ValueError("Craziness. The requested feed doesn't seem to exist.")
 
-        if not tools.is_array(feed_obj):
+        if not self._is_array[feed]:
             raise ValueError("Requested feed is not a CHIME antenna.")
 
         # If the angular position was not provided, then use the values in the
@@ -461,15 +493,11 @@ class CHIME(telescope.PolarisedTelescope):
             angpos = self._angpos
 
         # Get the beam rotation parameters.
-        yaw = -self.rotation_angle
-        pitch = 0.0
-        roll = 0.0
-
-        rot = np.radians([yaw, pitch, roll])
+        rot = self._beam_rotation
 
         # We can only support feeds angled parallel or perp to the cylinder
         # axis. Check for these and throw exception for anything else.
-        if tools.is_array_y(feed_obj):
+        if self._is_array_y[feed]:
             beam = cylbeam.beam_y(
                 angpos,
                 self.zenith,
@@ -478,7 +506,7 @@ class CHIME(telescope.PolarisedTelescope):
                 self.fwhm_hy[freq],
                 rot=rot,
             )
-        elif tools.is_array_x(feed_obj):
+        elif self._is_array_x[feed]:
             beam = cylbeam.beam_x(
                 angpos,
                 self.zenith,
@@ -512,28 +540,20 @@ class CHIME(telescope.PolarisedTelescope):
         uniq = telescope._get_indices(self._feedmap, mask=tmask)
 
         # Get channel id for each feed in the pair, this will be used for the sort
-        ci, cj = np.array([(self.feeds[fi].id, self.feeds[fj].id) for fi, fj in uniq]).T
-
-        # # Sort by constructing a numpy array with the keys as fields, and use
-        # # np.argsort to get the indices
-
-        # Create array of keys to sort
-        dt = np.dtype("i4,i4")
-        sort_arr = np.zeros(ci.size, dtype=dt)
-        sort_arr["f0"] = ci
-        sort_arr["f1"] = cj
+        feed_id = np.array([feed.id for feed in self.feeds], dtype=np.int32)
+        ci, cj = feed_id[uniq[:, 0]], feed_id[uniq[:, 1]]
 
-        # Get map which sorts
-        sort_ind = np.argsort(sort_arr)
+        # Get map which sorts by the first channel id and then by the second
+        sort_ind = np.lexsort((cj, ci))
 
         # Invert mapping
-        tmp_sort_ind = sort_ind.copy()
-        sort_ind[tmp_sort_ind] = np.arange(sort_ind.size)
+        inv_sort_ind = np.empty_like(sort_ind)
+        inv_sort_ind[sort_ind] = np.arange(sort_ind.size)
 
         # Remap feedmap entries
         fm_copy = self._feedmap.copy()
-        wmask = np.where(self._feedmask)
-        fm_copy[wmask] = sort_ind[self._feedmap[wmask]]
+        mask = self._feedmask
+        fm_copy[mask] = inv_sort_ind[self._feedmap[mask]]
 
         self._feedmap = fm_copy
 
@@ -547,8 +567,6 @@ class CHIME(telescope.PolarisedTelescope):
         # Reimplement unique baselines in order to mask out either according to total
         # baseline length or maximum North-South and East-West baseline seperation.
 
-        from drift.core import telescope
-
         # Construct array of indices
         fshape = [self.nfeed, self.nfeed]
         f_ind = np.indices(fshape)
@@ -613,20 +631,21 @@ class CHIME(telescope.PolarisedTelescope):
 
             beam = np.ones((self.nfreq, self.nfeed, 2), dtype=np.float64)
 
-            beam_lookup = {}
-
-            for fe, feed in enumerate(self.feeds):
-                if not tools.is_array(feed):
-                    continue
+            # Find the distinct beam classes of the CHIME feeds, and the first
+            # feed of each class which is used to evaluate the beam
+            feed_index = np.flatnonzero(self._is_array)
+            _, first, inverse = np.unique(
+                self.beamclass[feed_index], return_index=True, return_inverse=True
+            )
 
-                beamclass = self.beamclass[fe]
+            beam_lookup = np.ones((self.nfreq, len(first), 2), dtype=np.float64)
 
-                if beamclass not in beam_lookup:
-                    beam_lookup[beamclass] = np.ones((self.nfreq, 2), dtype=np.float64)
-                    for fr in range(self.nfreq):
-                        beam_lookup[beamclass][fr] = self.beam(fe, fr, angpos)[0]
+            for ci, fe in enumerate(feed_index[first]):
+                for fr in range(self.nfreq):
+                    beam_lookup[fr, ci] = self.beam(fe, fr, angpos)[0]
 
-                beam[:, fe, :] = beam_lookup[beamclass]
+            # Broadcast the beam of each class to all of its feeds
+            beam[:, feed_index] = beam_lookup[:, inverse.ravel()]
 
             self._beam_normalization = tools.invert_no_zero(
                 np.sqrt(np.sum(beam**2, axis=-1))
@@ -705,7 +724,7 @@ class CHIMEParameterizedBeam(CHIME):
         if feed_obj is None:
             raise ValueError("Craziness. The requested feed doesn't seem to exist.")
 
-        if not tools.is_array(feed_obj):
+        if not self._is_array[feed]:
             raise ValueError("Requested feed is not a CHIME antenna.")
 
         # If the angular position was not provided, then use the values in the
@@ -718,9 +737,9 @@ class CHIMEParameterizedBeam(CHIME):
 
         # We can only support feeds angled parallel or perp to the cylinder
         # axis. Check for these and throw exception for anything else.
-        if tools.is_array_x(feed_obj):
+        if self._is_array_x[feed]:
             pol = 0
-        elif tools.is_array_y(feed_obj):
+        elif self._is_array_y[feed]:
             pol = 1
         else:
             raise RuntimeError(
@@ -826,10 +845,10 @@ class CHIMEExternalBeam(CHIME):
             ]
 
             complex_beam = np.all(
-                [np.issubclass_(hpbt, np.complexfloating) for hpbt in hpb_types]
+                [np.issubdtype(hpbt, np.complexfloating) for hpbt in hpb_types]
             )
         else:
-            complex_beam = np.issubclass_(
+            complex_beam = np.issubdtype(
                 self._primary_beam.beam.dtype.type, np.complexfloating
             )
 
@@ -864,9 +883,9 @@ class CHIMEExternalBeam(CHIME):
         if feed_obj is None:
             raise ValueError("The requested feed doesn't seem to exist.")
 
-        if tools.is_array_x(feed_obj):
+        if self._is_array_x[feed]:
             pol_ind = self._beam_pol_map["X"]
-        elif tools.is_array_y(feed_obj):
+        elif self._is_array_y[feed]:
             pol_ind = self._beam_pol_map["Y"]
         else:
             raise ValueError("Polarisation not supported by this feed", feed_obj)
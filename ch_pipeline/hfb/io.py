@@ -121,15 +121,13 @@ class BaseLoadFiles(io.BaseLoadFiles):
         # Set up frequency selection.
         cfreq = np.linspace(800.0, 400.0, 1024, endpoint=False)
         if self.freq_phys_range:
-            freq_phys_start = np.max(self.freq_phys_range)
-            freq_phys_stop = np.min(self.freq_phys_range)
-            freq_index_start = np.argmin(np.abs(cfreq - freq_phys_start))
-            freq_index_stop = np.argmin(np.abs(cfreq - freq_phys_stop))
+            freq_phys = [np.max(self.freq_phys_range), np.min(self.freq_phys_range)]
+            freq_index_start, freq_index_stop = _nearest_channel(cfreq, freq_phys)
             self.freq_sel = slice(freq_index_start, freq_index_stop)
         elif self.freq_phys_list:
-            self.freq_sel = sorted(
-                set([np.argmin(np.abs(cfreq - freq)) for freq in self.freq_phys_list])
-            )
+            self.freq_sel = np.unique(
+                _nearest_channel(cfreq, self.freq_phys_list)
+            ).tolist()
         elif "freq_sel" in self._sel:
             self.freq_sel = self._sel["freq_sel"]
         else:
@@ -387,3 +385,23 @@ class LoadFiles(LoadFilesFromParams):
 
         # Call the baseclass setup to resolve any selections
         super().setup()
+
+
+def _nearest_channel(cfreq, freq):
+    """Find the channels closest to a set of frequencies.
+
+    Parameters
+    ----------
+    cfreq : np.ndarray[nchannel]
+        Centre frequencies of the channels.
+    freq : list or np.ndarray[nfreq]
+        Frequencies to look up.
+
+    Returns
+    -------
+    index : np.ndarray[nfreq]
+        Index of the closest channel to each frequency.
+    """
+    freq = np.asarray(freq, dtype=np.float64)
+
+    return np.argmin(np.abs(cfreq[:, np.newaxis] - freq[np.newaxis, :]), axis=0)
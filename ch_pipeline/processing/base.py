@@ -1,7 +1,9 @@
+import functools
 import re
 import warnings
 import yaml
 import os
+import shlex
 import subprocess as sp
 import tempfile
 from typing import Dict, Union, Tuple
@@ -23,6 +25,13 @@ DESC_HEAD = """# Revision `{}` of type `{}`
 Please describe the purpose/changes of this revision here.
 """
 
+# Revisions are labelled by a two digit code
+# TODO: decide if two digits (i.e. 100 revisions max is enough)
+REV_REGEX = re.compile(r"^rev_\d{2}$")
+
+# Subclasses of each processing type, cleared whenever a new type is defined
+_SUBCLASS_CACHE = {}
+
 
 class ProcessingType(object):
     """Baseclass for a pipeline processing type.
@@ -44,6 +53,12 @@ class ProcessingType(object):
     default_params = {}
     default_script = DEFAULT_SCRIPT
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        # Any cached list of subclasses may now be incomplete
+        _SUBCLASS_CACHE.clear()
+
     def __init__(self, revision, create=False, root_path=None):
         self.revision = revision
 
@@ -83,7 +98,8 @@ class ProcessingType(object):
         desc_path = self.base_path / "description.md"
         with desc_path.open("w") as fh:
             fh.write(DESC_HEAD.format(self.revision, self.type_name))
-        os.system(r"${EDITOR:-vi} " + str(desc_path))
+        editor = shlex.split(os.environ.get("EDITOR") or "vi")
+        sp.run(editor + [str(desc_path)], check=False)
 
     def _create_hook(self):
         """Implement to add custom behaviour when a revision is created.
@@ -159,21 +175,37 @@ class ProcessingType(object):
         if not base.exists():
             raise ValueError(f"Base path {base} does not exist.")
 
-        file_regex = re.compile(f"^{self.tag_pattern}$")
+        file_regex = full_match_regex(self.tag_pattern)
 
-        entries = [path for path in base.glob("*") if file_regex.match(path.name)]
+        entries = [name for name in dir_entries(base) if file_regex.match(name)]
 
         if time_sort:
             # Return the entries reverse sorted by time
             tags, times = zip(
                 *[
-                    (path.name, (path / "job/STATUS").stat().st_mtime)
-                    for path in entries
+                    (name, (base / name / "job/STATUS").stat().st_mtime)
+                    for name in entries
                 ]
             )
             return [x for _, x in sorted(zip(times, tags), reverse=True)]
         else:
-            return sorted([path.name for path in entries])
+            return sorted(entries)
+
+    @classmethod
+    def subclasses(cls) -> list:
+        """Get all subclasses of this processing type.
+
+        The result is cached until another processing type is defined.
+
+        Returns
+        -------
+        subclasses
+            List of all classes derived from this type.
+        """
+        if cls not in _SUBCLASS_CACHE:
+            _SUBCLASS_CACHE[cls] = all_subclasses(cls)
+
+        return _SUBCLASS_CACHE[cls]
 
     @classmethod
     def ls_type(cls, existing: bool = True) -> list:
@@ -190,11 +222,12 @@ class ProcessingType(object):
             list of processing types found
         """
 
-        type_names = [t.type_name for t in all_subclasses(cls)]
+        type_names = [t.type_name for t in cls.subclasses()]
 
         if existing:
             base = Path(cls.root_path)
-            return sorted([t.name for t in base.glob("*") if t.name in type_names])
+            type_set = set(type_names)
+            return sorted([name for name in dir_entries(base) if name in type_set])
         else:
             return type_names
 
@@ -210,11 +243,7 @@ class ProcessingType(object):
 
         base = Path(cls.root_path) / cls.type_name
 
-        # Revisions are labelled by a two digit code
-        # TODO: decide if two digits (i.e. 100 revisions max is enough)
-        rev_regex = re.compile("^rev_\d{2}$")
-
-        return sorted([t.name for t in base.glob("*") if rev_regex.match(t.name)])
+        return sorted([name for name in dir_entries(base) if REV_REGEX.match(name)])
 
     @classmethod
     def create_rev(cls):
@@ -249,7 +278,7 @@ class ProcessingType(object):
             List of running jobs.
         """
 
-        job_regex = re.compile(f"^{self.job_name(self.tag_pattern)}$")
+        job_regex = full_match_regex(self.job_name(self.tag_pattern))
 
         # Find matching jobs
         jobs = [job for job in slurm_jobs(user=user) if job_regex.match(job["NAME"])]
@@ -376,14 +405,42 @@ class ProcessingType(object):
 
     def _generate_hook(self, user: str = None) -> list:
         """Override to add custom behaviour when jobs are queued."""
-        return self.status(user=user)["not_yet_submitted"]
+        return self.not_yet_submitted(user=user)
+
+    def not_yet_submitted(self, user: str = None) -> list:
+        """Find the available tags that have not been submitted.
+
+        This is the same as `status()["not_yet_submitted"]`, but only does the
+        work needed for that entry, and doesn't look for finished or queued jobs
+        if there is nothing available.
+
+        Parameters
+        ----------
+        user
+            user to find running jobs for. If not provided, this
+            will default to the current user
+
+        Returns
+        -------
+        tags
+            Available tags which are not finished, pending or running.
+        """
+        available_tags = self.available()
+
+        if not available_tags:
+            return []
+
+        pending_tags, running_tags = self.queued(user)
+        submitted_tags = set(self.ls()) | set(pending_tags) | set(running_tags)
+
+        return [job for job in available_tags if job not in submitted_tags]
 
     def pending(self, user: str = None):
         """Jobs available to run."""
         warnings.warn(
             "'pending' method is deprecated. Call 'status()['not_yet_submitted']'."
         )
-        return self.status(user)["not_yet_submitted"]
+        return self.not_yet_submitted(user)
 
     def failed(self, user: str = None, time_sort: bool = False) -> Dict[str, list]:
         """Categorize failed jobs.
@@ -453,7 +510,7 @@ class ProcessingType(object):
             Return the tags associated with each status line: Available,
             Pending, Waiting, Running, Successful, Failed
         """
-        file_regex = re.compile(f"^{self.tag_pattern}$")
+        file_regex = full_match_regex(self.tag_pattern)
 
         # Get available, finished, pending, and running jobs
         available_tags = self.available()
@@ -552,26 +609,21 @@ def find_venv():
     path : str
         Path to the venv, or `None` if we are not in a virtual environment.
     """
-    import os
-
     return os.environ.get("VIRTUAL_ENV", None)
 
 
 def queue_job(script, submit=True):
     """Queue a pipeline script given as a string."""
 
-    import os
-
-    with tempfile.NamedTemporaryFile("w+") as fh:
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml") as fh:
         fh.write(script)
         fh.flush()
 
-        # TODO: do this in a better way
-        if submit:
-            cmd = "caput-pipeline queue %s"
-        else:
-            cmd = "caput-pipeline queue --nosubmit %s"
-        os.system(cmd % fh.name)
+        # Run directly rather than through a shell
+        cmd = ["caput-pipeline", "queue"]
+        if not submit:
+            cmd.append("--nosubmit")
+        sp.run(cmd + [fh.name], check=False)
 
 
 def classify_failed(
@@ -598,6 +650,9 @@ def classify_failed(
     """
     failed = {k: [] for k in list(patterns.keys())}
 
+    # Compile any patterns given as strings once, rather than for every tag
+    patterns = {k: [re.compile(p) for p in v] for k, v in patterns.items()}
+
     for tag in tags:
         file = Path(dir) / tag / "job" / "jobout.log"
         if not file.is_file():
@@ -605,19 +660,16 @@ def classify_failed(
         # Get the end of the file. Assume an average of 100 characters
         # per line, so get around 300 lines.
         with open(file, "rb") as f:
-            try:
-                f.seek(-300 * 100, os.SEEK_END)
-            except OSError:
-                # There was an issue reading the log file, so just assume
-                # that there's nothing there and classify this tag accordingly
-                tail = " "
-            else:
-                tail = f.read().decode()
+            # Check the size explicitly, as seeking to before the start of a
+            # short log would fail
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(size - 300 * 100, 0))
+            tail = f.read().decode()
 
         # See if any of the patterns that we are looking for
         # exist in the stdout
         for key, regex_patterns in patterns.items():
-            if any([bool(re.search(p, tail)) for p in regex_patterns]):
+            if any(p.search(tail) for p in regex_patterns):
                 failed[key].append(tag)
                 break
 
@@ -642,25 +694,20 @@ def slurm_jobs(user: str = None) -> list:
 
         user = getpass.getuser()
 
-    # Call squeue to get the users jobs and get it's stdout
+    # Call squeue to get the users jobs. The stdout is parsed line by line as
+    # it is read rather than being stored in full
     try:
         process = sp.Popen(
             ["squeue", "-u", user, "-o", "%all"],
             stdout=sp.PIPE,
-            stderr=sp.PIPE,
+            stderr=sp.DEVNULL,
             shell=False,
             universal_newlines=True,
         )
-        proc_stdout, proc_stderr = process.communicate()
-        lines = proc_stdout.split("\n")
     except OSError:
         warnings.warn('Failure running "squeue".')
         return []
 
-    # Extract the headers
-    header_line = lines.pop(0)
-    header_cols = header_line.split("|")
-
     def slurm_split(line):
         # Split an squeue line accounting for the partitions
 
@@ -668,34 +715,43 @@ def slurm_jobs(user: str = None) -> list:
 
         fields = []
 
-        t = None
+        buf = []
+        br = 0
         for token in tokens:
-            t = token if t is None else t + "|" + token
+            buf.append(token)
 
-            # Check if the token is balanced with square brackets
-            br = t.count("[") - t.count("]")
+            # Keep a running count of the square bracket balance, only looking
+            # at the newly added token
+            br += token.count("[") - token.count("]")
 
             # If balanced keep the whole token, otherwise we keep will just
             # continue to see if the next token balances it
             if br == 0:
-                fields.append(t)
-                t = None
+                fields.append("|".join(buf))
+                buf = []
 
         return fields
 
-    # Iterate over the following entries and parse them into queue jobs
     entries = []
     error_lines = []  # do something with this later
-    for line in lines:
-        parts = slurm_split(line)
-        d = {}
 
-        if len(parts) != len(header_cols):
-            error_lines.append((len(parts), line, parts))
-        else:
-            for i, key in enumerate(header_cols):
-                d[key] = parts[i]
-            entries.append(d)
+    with process:
+        # Extract the headers
+        header_line = process.stdout.readline().rstrip("\n")
+        header_cols = header_line.split("|")
+
+        # Iterate over the following entries and parse them into queue jobs
+        for line in process.stdout:
+            line = line.rstrip("\n")
+            parts = slurm_split(line)
+            d = {}
+
+            if len(parts) != len(header_cols):
+                error_lines.append((len(parts), line, parts))
+            else:
+                for i, key in enumerate(header_cols):
+                    d[key] = parts[i]
+                entries.append(d)
 
     return entries
 
@@ -761,3 +817,45 @@ def all_subclasses(cls):
             stack.append(c)
 
     return subclasses
+
+
+def dir_entries(path: Path) -> list:
+    """List the names of the entries in a directory.
+
+    This uses `os.scandir` so no `Path` objects are created for the entries.
+
+    Parameters
+    ----------
+    path
+        The directory to list.
+
+    Returns
+    -------
+    names
+        The names of the entries. Empty if the directory does not exist.
+    """
+    try:
+        with os.scandir(path) as it:
+            return [entry.name for entry in it]
+    except FileNotFoundError:
+        return []
+
+
+@functools.lru_cache(maxsize=None)
+def full_match_regex(pattern: str) -> re.Pattern:
+    """Compile a regular expression that must match the whole string.
+
+    The compiled expressions are cached, so repeated calls for the same pattern
+    are cheap.
+
+    Parameters
+    ----------
+    pattern
+        The regular expression.
+
+    Returns
+    -------
+    regex
+        The compiled expression anchored at both ends.
+    """
+    return re.compile(f"^{pattern}$")
@@ -164,7 +164,7 @@ def item_list(revision, long, human, time):
 def pending(revision):
     """List items that do not exist within REVISION
     (given as type:revision) but can be generated."""
-    pending = revision.status()["not_yet_submitted"]
+    pending = revision.not_yet_submitted()
     for tag in pending:
         click.echo(tag)
 
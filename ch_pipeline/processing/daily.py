@@ -981,7 +981,7 @@ class DailyProcessing(base.ProcessingType):
         return jobparams
 
     def _generate_hook(self, user=None):
-        to_run = self.status(user=user)["not_yet_submitted"]
+        to_run = self.not_yet_submitted(user=user)
 
         buffer = 2
         today = math.floor(ephemeris.chime.get_current_lsd()) - buffer